@@ -14,69 +14,256 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import multiprocessing
 import os
+import pathlib
+import re
 import subprocess
 import sys
 import tempfile
 from textwrap import dedent
-from unittest import mock
+from typing import Dict, Iterable, List
 
 import fixtures
+import pytest
 from testtools.matchers import Contains, Equals, GreaterThan, Not
 
 import snapcraft
-from snapcraft.internal import common
+from snapcraft.internal import common, project_loader
+from snapcraft.project import Project
 from tests.fixture_setup.os_release import FakeOsRelease
 
 from . import ProjectLoaderBaseTest
 
 
+_YAML_DEFAULT = dedent(
+    """\
+    name: test
+    base: core18
+    version: "1"
+    summary: test
+    description: test
+    confinement: strict
+    grade: stable
+
+    parts:
+      part1:
+        plugin: nil
+    """
+)
+
+
+_YAML_DEDUP = dedent(
+    """\
+    name: test
+    base: core18
+    version: "1"
+    summary: test
+    description: test
+    confinement: strict
+    grade: stable
+
+    parts:
+      main:
+        plugin: nil
+        after: [part1, part2, part3]
+      part1:
+        plugin: nil
+      part2:
+        plugin: nil
+      part3:
+        plugin: nil
+    """
+)
+
+
+_YAML_CLASSIC = dedent(
+    """\
+    name: test
+    base: core18
+    version: "1"
+    summary: test
+    description: test
+    confinement: classic
+    grade: stable
+
+    parts:
+      part1:
+        plugin: nil
+    """
+)
+
+
+_YAML_DEPS = dedent(
+    """\
+    name: test
+    base: core18
+    version: "1"
+    summary: test
+    description: test
+    confinement: strict
+    grade: stable
+
+    parts:
+      part1:
+        plugin: nil
+      part2:
+        plugin: nil
+        after: [part1]
+    """
+)
+
+
+_YAML_BUILDENV = dedent(
+    """\
+    name: test
+    base: core18
+    version: "1"
+    summary: test
+    description: test
+    confinement: strict
+    grade: stable
+
+    parts:
+      part1:
+        plugin: nil
+        build-environment:
+          - FOO: BAR
+    """
+)
+
+
+_YAML_BUILDENV_GLOBAL = dedent(
+    """\
+    name: test
+    base: core18
+    version: "1"
+    summary: test
+    description: test
+    confinement: strict
+    grade: stable
+
+    parts:
+      part1:
+        plugin: nil
+        build-environment:
+          - PROJECT_NAME: $SNAPCRAFT_PROJECT_NAME
+    """
+)
+
+
+_YAML_BUILDENV_PART = dedent(
+    """\
+    name: test
+    base: core18
+    version: "1"
+    summary: test
+    description: test
+    confinement: strict
+    grade: stable
+
+    parts:
+      part1:
+        plugin: nil
+        build-environment:
+          - PART_INSTALL: $SNAPCRAFT_PART_INSTALL
+    """
+)
+
+
+_YAML_BUILDENV_LEAK = dedent(
+    """\
+    name: test
+    base: core18
+    version: "1"
+    summary: test
+    description: test
+    confinement: strict
+    grade: stable
+
+    parts:
+      part1:
+        plugin: nil
+        build-environment:
+          - FOO: BAR
+
+      part2:
+        plugin: nil
+        after: [part1]
+        build-environment:
+          - BAZ: QUX
+    """
+)
+
+
+_SHELL_ENV = {
+    "CFLAGS": "-I/user-provided",
+    "CXXFLAGS": "-I/user-provided",
+    "CPPFLAGS": "-I/user-provided",
+    "LDFLAGS": "-L/user-provided",
+    "LD_LIBRARY_PATH": "/user-provided",
+}
+
+_LD_RE = re.compile(r'^LD_LIBRARY_PATH="([^"]*)"$')
+_EXPORT_RE = re.compile(r'^(\w+)="(.*)"$')
+_PARAMETER_RE = re.compile(r"\$(?:{(\w+)(?::([+-])([^}]*))?}|(\w+))")
+
+
+def _expand_parameters(value: str, environment: Dict[str, str]) -> str:
+    def _expand(match):
+        name = match.group(1) or match.group(4)
+        current = environment.get(name, "")
+        operator, word = match.group(2), match.group(3)
+        if operator == "+":
+            return _expand_parameters(word, environment) if current else ""
+        if operator == "-" and not current:
+            return _expand_parameters(word, environment)
+        return current
+
+    return _PARAMETER_RE.sub(_expand, value)
+
+
+def expand_exports(env_lines: List[str], shell_env: Dict[str, str], var: str) -> str:
+    """Return the value of var after exporting env_lines on top of shell_env.
+
+    This evaluates the VAR="value" definitions generated by snapcraft the way
+    /bin/sh would, supporting only the $VAR, ${VAR}, ${VAR:+word} and
+    ${VAR:-word} expansions they make use of.
+    """
+    environment = dict(shell_env)
+    for line in env_lines:
+        match = _EXPORT_RE.match(line)
+        if match is None:
+            raise ValueError("Unexpected environment line: {!r}".format(line))
+        environment[match.group(1)] = _expand_parameters(match.group(2), environment)
+
+    return environment.get(var, "")
+
+
+def _env_order(environment: List[str]) -> Dict[str, int]:
+    """Return the index of the last definition of each variable in environment."""
+    return {v.split("=", 1)[0]: i for i, v in enumerate(environment)}
+
+
+def _mkdirs(paths: Iterable[str]) -> None:
+    """Create every directory in paths.
+
+    The deepest paths are created first so that their parents, which
+    os.makedirs creates along the way, are not walked again.
+    """
+    created = []  # type: List[str]
+    for path in sorted(paths, key=len, reverse=True):
+        if any(c == path or c.startswith(path + os.sep) for c in created):
+            continue
+        os.makedirs(path, exist_ok=True)
+        created.append(path)
+
+
 class EnvironmentTest(ProjectLoaderBaseTest):
     def setUp(self):
         super().setUp()
 
-        self.snapcraft_yaml = dedent(
-            """\
-            name: test
-            base: core18
-            version: "1"
-            summary: test
-            description: test
-            confinement: strict
-            grade: stable
-
-            parts:
-              part1:
-                plugin: nil
-        """
-        )
-
-    def test_config_snap_environment(self):
-        project_config = self.make_snapcraft_project(self.snapcraft_yaml)
-
-        lib_paths = [
-            os.path.join(self.prime_dir, "lib"),
-            os.path.join(self.prime_dir, "usr", "lib"),
-        ]
-        for lib_path in lib_paths:
-            os.makedirs(lib_path)
-
-        environment = project_config.snap_env()
-        self.assertThat(
-            environment,
-            Contains(
-                'PATH="{0}/usr/sbin:{0}/usr/bin:{0}/sbin:{0}/bin${{PATH:+:$PATH}}"'.format(
-                    self.prime_dir
-                )
-            ),
-        )
-        self.assertThat(
-            environment,
-            Contains(
-                'LD_LIBRARY_PATH="${{LD_LIBRARY_PATH:+$LD_LIBRARY_PATH:}}'
-                '{0}/lib:{0}/usr/lib"'.format(self.prime_dir)
-            ),
-        )
+        self.snapcraft_yaml = _YAML_DEFAULT
 
     def test_config_snap_environment_with_no_library_paths(self):
         project_config = self.make_snapcraft_project(self.snapcraft_yaml)
@@ -89,24 +276,26 @@ class EnvironmentTest(ProjectLoaderBaseTest):
             in environment,
             "Current PATH is {!r}".format(environment),
         )
-        for e in environment:
-            self.assertFalse(
-                "LD_LIBRARY_PATH" in e, "Current environment is {!r}".format(e)
-            )
+        self.assertFalse(
+            any(v.startswith("LD_LIBRARY_PATH=") for v in environment),
+            "Current environment is {!r}".format(environment),
+        )
 
-    @mock.patch.object(
-        snapcraft.internal.pluginhandler.PluginHandler, "get_primed_dependency_paths"
-    )
-    def test_config_snap_environment_with_dependencies(self, mock_get_dependencies):
+    def test_config_snap_environment_with_dependencies(self):
         library_paths = {
             os.path.join(self.prime_dir, "lib1"),
             os.path.join(self.prime_dir, "lib2"),
         }
-        mock_get_dependencies.return_value = library_paths
+        self.useFixture(
+            fixtures.MonkeyPatch(
+                "snapcraft.internal.pluginhandler.PluginHandler."
+                "get_primed_dependency_paths",
+                lambda self: library_paths,
+            )
+        )
         project_config = self.make_snapcraft_project(self.snapcraft_yaml)
 
-        for lib_path in library_paths:
-            os.makedirs(lib_path)
+        _mkdirs(library_paths)
 
         # Ensure that LD_LIBRARY_PATH is present and it contains the
         # extra dependency paths.
@@ -119,87 +308,34 @@ class EnvironmentTest(ProjectLoaderBaseTest):
             ),
         )
 
-    @mock.patch.object(
-        snapcraft.internal.pluginhandler.PluginHandler, "get_primed_dependency_paths"
-    )
-    def test_config_snap_environment_with_dependencies_but_no_paths(
-        self, mock_get_dependencies
-    ):
+    def test_config_snap_environment_with_dependencies_but_no_paths(self):
         library_paths = {
             os.path.join(self.prime_dir, "lib1"),
             os.path.join(self.prime_dir, "lib2"),
         }
-        mock_get_dependencies.return_value = library_paths
+        self.useFixture(
+            fixtures.MonkeyPatch(
+                "snapcraft.internal.pluginhandler.PluginHandler."
+                "get_primed_dependency_paths",
+                lambda self: library_paths,
+            )
+        )
         project_config = self.make_snapcraft_project(self.snapcraft_yaml)
 
         # Ensure that LD_LIBRARY_PATH is present, but is completey empty since
         # no library paths actually exist.
-        for variable in project_config.snap_env():
-            self.assertFalse(
-                "LD_LIBRARY_PATH" in variable,
-                "Expected no LD_LIBRARY_PATH (got {!r})".format(variable),
-            )
-
-    def test_config_runtime_environment_ld(self):
-        # Place a few ld.so.conf files in supported locations. We expect the
-        # contents of these to make it into the LD_LIBRARY_PATH.
-        mesa_dir = os.path.join(self.prime_dir, "usr", "lib", "my_arch", "mesa")
-        os.makedirs(mesa_dir)
-        with open(os.path.join(mesa_dir, "ld.so.conf"), "w") as f:
-            f.write("/mesa")
-
-        mesa_egl_dir = os.path.join(self.prime_dir, "usr", "lib", "my_arch", "mesa-egl")
-        os.makedirs(mesa_egl_dir)
-        with open(os.path.join(mesa_egl_dir, "ld.so.conf"), "w") as f:
-            f.write("# Standalone comment\n")
-            f.write("/mesa-egl")
-
-        project_config = self.make_snapcraft_project(self.snapcraft_yaml)
         environment = project_config.snap_env()
-
-        # Ensure that the LD_LIBRARY_PATH includes all the above paths
-        paths = []
-        for variable in environment:
-            if "LD_LIBRARY_PATH" in variable:
-                these_paths = variable.split("=")[1].strip()
-                paths.extend(these_paths.replace('"', "").split(":"))
-
-        self.assertTrue(len(paths) > 0, "Expected LD_LIBRARY_PATH to be in environment")
-
-        expected = (os.path.join(self.prime_dir, i) for i in ["mesa", "mesa-egl"])
-        for item in expected:
-            self.assertTrue(
-                item in paths, 'Expected LD_LIBRARY_PATH to include "{}"'.format(item)
-            )
+        self.assertFalse(
+            any(v.startswith("LD_LIBRARY_PATH=") for v in environment),
+            "Expected no LD_LIBRARY_PATH (got {!r})".format(environment),
+        )
 
     def test_config_env_dedup(self):
         """Regression test for LP: #1767625.
         Verify that the use of after with multiple parts does not produce
         duplicate exports.
         """
-        snapcraft_yaml = dedent(
-            """\
-            name: test
-            base: core18
-            version: "1"
-            summary: test
-            description: test
-            confinement: strict
-            grade: stable
-
-            parts:
-              main:
-                plugin: nil
-                after: [part1, part2, part3]
-              part1:
-                plugin: nil
-              part2:
-                plugin: nil
-              part3:
-                plugin: nil
-        """
-        )
-        project_config = self.make_snapcraft_project(snapcraft_yaml)
+        project_config = self.make_snapcraft_project(_YAML_DEDUP)
         part = project_config.parts.get_part("main")
         environment = project_config.parts.build_env_for_part(part, root_part=True)
         # We sort here for equality checking but they should not be sorted
@@ -251,22 +387,7 @@ class EnvironmentTest(ProjectLoaderBaseTest):
     def test_config_stage_environment_confinement_classic(self):
         self.useFixture(FakeOsRelease())
 
-        snapcraft_yaml = dedent(
-            """\
-            name: test
-            base: core18
-            version: "1"
-            summary: test
-            description: test
-            confinement: classic
-            grade: stable
-
-            parts:
-              part1:
-                plugin: nil
-        """
-        )
-        project_config = self.make_snapcraft_project(snapcraft_yaml)
+        project_config = self.make_snapcraft_project(_YAML_CLASSIC)
         part = project_config.parts.get_part("part1")
         environment = project_config.parts.build_env_for_part(part, root_part=True)
         self.assertThat(
@@ -283,30 +404,10 @@ class EnvironmentTest(ProjectLoaderBaseTest):
             ),
         )
 
-    def test_parts_build_env_ordering_with_deps(self):
-        snapcraft_yaml = dedent(
-            """\
-            name: test
-            base: core18
-            version: "1"
-            summary: test
-            description: test
-            confinement: strict
-            grade: stable
-
-            parts:
-              part1:
-                plugin: nil
-              part2:
-                plugin: nil
-                after: [part1]
-        """
-        )
-
+    def _make_build_env_with_deps(self):
         self.useFixture(fixtures.EnvironmentVariable("PATH", "/bin"))
 
         arch_triplet = snapcraft.ProjectOptions().arch_triplet
-        self.maxDiff = None
         paths = [
             os.path.join(self.stage_dir, "lib"),
             os.path.join(self.stage_dir, "lib", arch_triplet),
@@ -321,31 +422,19 @@ class EnvironmentTest(ProjectLoaderBaseTest):
             os.path.join(self.parts_dir, "part2", "install", "include"),
             os.path.join(self.parts_dir, "part2", "install", "lib"),
         ]
-        for path in paths:
-            os.makedirs(path)
-
-        project_config = self.make_snapcraft_project(snapcraft_yaml)
-        part2 = [
-            part for part in project_config.parts.all_parts if part.name == "part2"
-        ][0]
-        env = project_config.parts.build_env_for_part(part2)
-        env_lines = "\n".join(["export {}\n".format(e) for e in env])
+        _mkdirs(paths)
 
-        shell_env = {
-            "CFLAGS": "-I/user-provided",
-            "CXXFLAGS": "-I/user-provided",
-            "CPPFLAGS": "-I/user-provided",
-            "LDFLAGS": "-L/user-provided",
-            "LD_LIBRARY_PATH": "/user-provided",
-        }
+        project_config = self.make_snapcraft_project(_YAML_DEPS)
+        part2 = project_config.parts.get_part("part2")
+
+        return project_config, project_config.parts.build_env_for_part(part2)
+
+    def test_parts_build_env_ordering_with_deps(self):
+        project_config, env = self._make_build_env_with_deps()
+        self.maxDiff = None
 
         def get_envvar(envvar):
-            with tempfile.NamedTemporaryFile(mode="w+") as f:
-                f.write(env_lines)
-                f.write("echo ${}".format(envvar))
-                f.flush()
-                output = subprocess.check_output(["/bin/sh", f.name], env=shell_env)
-            return output.decode(sys.getfilesystemencoding()).strip()
+            return expand_exports(env, _SHELL_ENV, envvar)
 
         expected_cflags = (
             "-I/user-provided "
@@ -392,197 +481,73 @@ class EnvironmentTest(ProjectLoaderBaseTest):
             ),
         )
 
-    @mock.patch("os.sched_getaffinity", return_value=set(range(0, 42)))
-    def test_parts_build_env_contains_parallel_build_count(self, cpu_mock):
-        project_config = self.make_snapcraft_project(self.snapcraft_yaml)
-        part1 = [
-            part for part in project_config.parts.all_parts if part.name == "part1"
-        ][0]
-        env = project_config.parts.build_env_for_part(part1)
-        self.assertThat(env, Contains('SNAPCRAFT_PARALLEL_BUILD_COUNT="42"'))
+    @pytest.mark.slow
+    def test_parts_build_env_ordering_with_deps_in_shell(self):
+        """Cross-check expand_exports against a real shell."""
+        project_config, env = self._make_build_env_with_deps()
+        env_lines = "\n".join(["export {}\n".format(e) for e in env])
 
-    @mock.patch("os.sched_getaffinity", side_effect=AttributeError)
-    @mock.patch("multiprocessing.cpu_count", return_value=42)
-    def test_parts_build_env_contains_parallel_build_count_no_getaffinity(
-        self, affinity_mock, cpu_mock
-    ):
-        project_config = self.make_snapcraft_project(self.snapcraft_yaml)
-        part1 = [
-            part for part in project_config.parts.all_parts if part.name == "part1"
-        ][0]
-        env = project_config.parts.build_env_for_part(part1)
-        self.assertThat(env, Contains('SNAPCRAFT_PARALLEL_BUILD_COUNT="42"'))
+        for envvar in ["CFLAGS", "CXXFLAGS", "CPPFLAGS", "LDFLAGS", "LD_LIBRARY_PATH"]:
+            with tempfile.NamedTemporaryFile(mode="w+") as f:
+                f.write(env_lines)
+                f.write("echo ${}".format(envvar))
+                f.flush()
+                output = subprocess.check_output(["/bin/sh", f.name], env=_SHELL_ENV)
 
-    @mock.patch("os.sched_getaffinity", side_effect=AttributeError)
-    @mock.patch("multiprocessing.cpu_count", side_effect=NotImplementedError)
-    def test_parts_build_env_contains_parallel_build_count_no_cpucount(
-        self, affinity_mock, cpu_mock
-    ):
-        project_config = self.make_snapcraft_project(self.snapcraft_yaml)
-        part1 = [
-            part for part in project_config.parts.all_parts if part.name == "part1"
-        ][0]
-        env = project_config.parts.build_env_for_part(part1)
-        self.assertThat(env, Contains('SNAPCRAFT_PARALLEL_BUILD_COUNT="1"'))
+            self.assertThat(
+                output.decode(sys.getfilesystemencoding()).strip(),
+                Equals(expand_exports(env, _SHELL_ENV, envvar)),
+            )
 
     def test_extension_dir(self):
         common.set_extensionsdir("/foo")
         project_config = self.make_snapcraft_project(self.snapcraft_yaml)
-        part1 = [
-            part for part in project_config.parts.all_parts if part.name == "part1"
-        ][0]
+        part1 = project_config.parts.get_part("part1")
         env = project_config.parts.build_env_for_part(part1)
         self.assertThat(env, Contains('SNAPCRAFT_EXTENSIONS_DIR="/foo"'))
 
-    def test_project_dir(self):
-        project_config = self.make_snapcraft_project(self.snapcraft_yaml)
-        env = project_config.parts.build_env_for_part(project_config.parts.all_parts[0])
-        self.assertThat(env, Contains('SNAPCRAFT_PROJECT_DIR="{}"'.format(self.path)))
-
-    def test_content_dirs_default(self):
-        project_config = self.make_snapcraft_project(self.snapcraft_yaml)
-        env = project_config.parts.build_env_for_part(project_config.parts.all_parts[0])
-        self.assertThat(env, Contains('SNAPCRAFT_CONTENT_DIRS=""'))
-
-    @mock.patch(
-        "snapcraft.project._project.Project._get_provider_content_dirs",
-        return_value=sorted({"/tmp/test1", "/tmp/test2"}),
-    )
-    def test_content_dirs(self, mock_get_content_dirs):
+    def test_content_dirs(self):
+        self.useFixture(
+            fixtures.MonkeyPatch(
+                "snapcraft.project._project.Project._get_provider_content_dirs",
+                lambda self: sorted({"/tmp/test1", "/tmp/test2"}),
+            )
+        )
         project_config = self.make_snapcraft_project(self.snapcraft_yaml)
-        env = project_config.parts.build_env_for_part(project_config.parts.all_parts[0])
+        part1 = project_config.parts.get_part("part1")
+        env = project_config.parts.build_env_for_part(part1)
         self.assertThat(env, Contains('SNAPCRAFT_CONTENT_DIRS="/tmp/test1:/tmp/test2"'))
 
     def test_build_environment(self):
-        self.useFixture(FakeOsRelease())
-
-        snapcraft_yaml = dedent(
-            """\
-            name: test
-            base: core18
-            version: "1"
-            summary: test
-            description: test
-            confinement: strict
-            grade: stable
-
-            parts:
-              part1:
-                plugin: nil
-                build-environment:
-                  - FOO: BAR
-        """
-        )
-        project_config = self.make_snapcraft_project(snapcraft_yaml)
+        project_config = self.make_snapcraft_project(_YAML_BUILDENV)
         part = project_config.parts.get_part("part1")
         environment = project_config.parts.build_env_for_part(part)
         self.assertThat(environment, Contains('FOO="BAR"'))
 
     def test_build_environment_can_depend_on_global_env(self):
-        self.useFixture(FakeOsRelease())
-
-        snapcraft_yaml = dedent(
-            """\
-            name: test
-            base: core18
-            version: "1"
-            summary: test
-            description: test
-            confinement: strict
-            grade: stable
-
-            parts:
-              part1:
-                plugin: nil
-                build-environment:
-                  - PROJECT_NAME: $SNAPCRAFT_PROJECT_NAME
-        """
-        )
-        project_config = self.make_snapcraft_project(snapcraft_yaml)
+        project_config = self.make_snapcraft_project(_YAML_BUILDENV_GLOBAL)
         part = project_config.parts.get_part("part1")
         environment = project_config.parts.build_env_for_part(part)
-        snapcraft_definition_index = -1
-        build_environment_definition_index = -1
-        for index, variable in enumerate(environment):
-            if variable.startswith("SNAPCRAFT_PROJECT_NAME="):
-                snapcraft_definition_index = index
-            if variable.startswith("PROJECT_NAME="):
-                build_environment_definition_index = index
-
-        # Assert that each definition was found, and the global env came before the
-        # build environment
-        self.assertThat(snapcraft_definition_index, GreaterThan(-1))
-        self.assertThat(build_environment_definition_index, GreaterThan(-1))
+        env_index = _env_order(environment)
+
+        # Assert that the global env came before the build environment
         self.assertThat(
-            build_environment_definition_index, GreaterThan(snapcraft_definition_index)
+            env_index["PROJECT_NAME"], GreaterThan(env_index["SNAPCRAFT_PROJECT_NAME"])
         )
 
     def test_build_environment_can_depend_on_part_env(self):
-        self.useFixture(FakeOsRelease())
-
-        snapcraft_yaml = dedent(
-            """\
-            name: test
-            base: core18
-            version: "1"
-            summary: test
-            description: test
-            confinement: strict
-            grade: stable
-
-            parts:
-              part1:
-                plugin: nil
-                build-environment:
-                  - PART_INSTALL: $SNAPCRAFT_PART_INSTALL
-        """
-        )
-        project_config = self.make_snapcraft_project(snapcraft_yaml)
+        project_config = self.make_snapcraft_project(_YAML_BUILDENV_PART)
         part = project_config.parts.get_part("part1")
         environment = project_config.parts.build_env_for_part(part)
-        snapcraft_definition_index = -1
-        build_environment_definition_index = -1
-        for index, variable in enumerate(environment):
-            if variable.startswith("SNAPCRAFT_PART_INSTALL="):
-                snapcraft_definition_index = index
-            if variable.startswith("PART_INSTALL="):
-                build_environment_definition_index = index
-
-        # Assert that each definition was found, and the part env came before the
-        # build environment
-        self.assertThat(snapcraft_definition_index, GreaterThan(-1))
-        self.assertThat(build_environment_definition_index, GreaterThan(-1))
+        env_index = _env_order(environment)
+
+        # Assert that the part env came before the build environment
         self.assertThat(
-            build_environment_definition_index, GreaterThan(snapcraft_definition_index)
+            env_index["PART_INSTALL"], GreaterThan(env_index["SNAPCRAFT_PART_INSTALL"])
         )
 
     def test_build_environment_with_dependencies_does_not_leak(self):
-        self.useFixture(FakeOsRelease())
-
-        snapcraft_yaml = dedent(
-            """\
-            name: test
-            base: core18
-            version: "1"
-            summary: test
-            description: test
-            confinement: strict
-            grade: stable
-
-            parts:
-              part1:
-                plugin: nil
-                build-environment:
-                  - FOO: BAR
-
-              part2:
-                plugin: nil
-                after: [part1]
-                build-environment:
-                  - BAZ: QUX
-        """
-        )
-        project_config = self.make_snapcraft_project(snapcraft_yaml)
+        project_config = self.make_snapcraft_project(_YAML_BUILDENV_LEAK)
         part1 = project_config.parts.get_part("part1")
         part2 = project_config.parts.get_part("part2")
         self.assertThat(
@@ -594,3 +559,125 @@ class EnvironmentTest(ProjectLoaderBaseTest):
         self.assertThat(
             project_config.parts.build_env_for_part(part2), Contains('BAZ="QUX"')
         )
+
+
+def get_project_config(snapcraft_yaml_content):
+    snapcraft_yaml_path = pathlib.Path("snap", "snapcraft.yaml")
+    snapcraft_yaml_path.parent.mkdir(exist_ok=True)
+    snapcraft_yaml_path.write_text(snapcraft_yaml_content)
+
+    project = Project(snapcraft_yaml_file_path=snapcraft_yaml_path.as_posix())
+    return project_loader.load_config(project)
+
+
+@pytest.fixture(scope="module")
+def default_project_path(tmp_path_factory):
+    """Return the project directory used by default_project_config."""
+    return tmp_path_factory.mktemp("default-project")
+
+
+@pytest.fixture(scope="module")
+def default_project_config(default_project_path):
+    """Return the config for _YAML_DEFAULT, loaded once for the whole module.
+
+    Tests using this fixture must not modify the returned config.
+    """
+    # The project directory is taken from the current working directory.
+    cwd = os.getcwd()
+    os.chdir(default_project_path)
+    try:
+        return get_project_config(_YAML_DEFAULT)
+    finally:
+        os.chdir(cwd)
+
+
+def test_config_snap_environment(tmp_work_path):
+    prime_dir = tmp_work_path / "prime"
+    _mkdirs([os.path.join(prime_dir, "lib"), os.path.join(prime_dir, "usr", "lib")])
+
+    project_config = get_project_config(_YAML_DEFAULT)
+
+    environment = project_config.snap_env()
+
+    assert (
+        'PATH="{0}/usr/sbin:{0}/usr/bin:{0}/sbin:{0}/bin${{PATH:+:$PATH}}"'.format(
+            prime_dir
+        )
+        in environment
+    )
+    assert (
+        'LD_LIBRARY_PATH="${{LD_LIBRARY_PATH:+$LD_LIBRARY_PATH:}}'
+        '{0}/lib:{0}/usr/lib"'.format(prime_dir) in environment
+    )
+
+
+def test_config_runtime_environment_ld(tmp_work_path):
+    prime_path = tmp_work_path / "prime"
+
+    # Place a few ld.so.conf files in supported locations. We expect the
+    # contents of these to make it into the LD_LIBRARY_PATH.
+    mesa_path = prime_path / "usr" / "lib" / "my_arch" / "mesa"
+    mesa_egl_path = prime_path / "usr" / "lib" / "my_arch" / "mesa-egl"
+    _mkdirs([mesa_path.as_posix(), mesa_egl_path.as_posix()])
+
+    (mesa_path / "ld.so.conf").write_text("/mesa")
+    (mesa_egl_path / "ld.so.conf").write_text("# Standalone comment\n/mesa-egl")
+
+    project_config = get_project_config(_YAML_DEFAULT)
+    environment = project_config.snap_env()
+
+    # Ensure that the LD_LIBRARY_PATH includes all the above paths
+    paths = next(
+        (m.group(1).split(":") for m in map(_LD_RE.match, environment) if m), []
+    )
+
+    assert len(paths) > 0, "Expected LD_LIBRARY_PATH to be in environment"
+
+    for item in (os.path.join(prime_path, i) for i in ["mesa", "mesa-egl"]):
+        assert item in paths, 'Expected LD_LIBRARY_PATH to include "{}"'.format(item)
+
+
+def _fake_call(result):
+    """Return a function raising result if it is an exception, else returning it."""
+
+    def _call(*args):
+        if isinstance(result, type) and issubclass(result, Exception):
+            raise result()
+        return result
+
+    return _call
+
+
+@pytest.mark.parametrize(
+    "affinity,cpu_count,expected",
+    [
+        (set(range(0, 42)), None, "42"),
+        (AttributeError, 42, "42"),
+        (AttributeError, NotImplementedError, "1"),
+    ],
+    ids=["getaffinity", "no getaffinity", "no cpu count"],
+)
+def test_parts_build_env_contains_parallel_build_count(
+    monkeypatch, default_project_config, affinity, cpu_count, expected
+):
+    monkeypatch.setattr(os, "sched_getaffinity", _fake_call(affinity))
+    monkeypatch.setattr(multiprocessing, "cpu_count", _fake_call(cpu_count))
+
+    part1 = default_project_config.parts.get_part("part1")
+    env = default_project_config.parts.build_env_for_part(part1)
+
+    assert 'SNAPCRAFT_PARALLEL_BUILD_COUNT="{}"'.format(expected) in env
+
+
+def test_project_dir(default_project_path, default_project_config):
+    part1 = default_project_config.parts.get_part("part1")
+    env = default_project_config.parts.build_env_for_part(part1)
+
+    assert 'SNAPCRAFT_PROJECT_DIR="{}"'.format(default_project_path) in env
+
+
+def test_content_dirs_default(default_project_config):
+    part1 = default_project_config.parts.get_part("part1")
+    env = default_project_config.parts.build_env_for_part(part1)
+
+    assert 'SNAPCRAFT_CONTENT_DIRS=""' in env